@@ -1,21 +1,152 @@
 from __future__ import annotations
 
 import fire
+import logging
 import mido
+import os
 import sounddevice as sd
 import soundfile as sf
 import sys
 import queue
+import threading
 import time
 import numpy as np
 
-from mido import MetaMessage, MidiFile, open_output
+from contextlib import ExitStack, closing, contextmanager
+from mido import Message, MidiFile, open_output
 from pathlib import Path
+from types import SimpleNamespace
 from tqdm import tqdm
 
-from piano_capture.util import print_banner
+from piano_capture.util import gc_paused, print_banner
 from piano_capture.darwin_realtime import enable_realtime
 
+# Extra recording time (beyond the MIDI duration) to reserve in the audio buffer.
+RECORDING_PAD_SEC = 10
+
+# Sample format of the input stream and the recording buffer, and the WAV subtype it
+# is written as. 24-bit samples arrive left-aligned in 32-bit integers, which
+# soundfile packs into PCM_24 directly, without a float conversion pass.
+RECORDING_DTYPE = "int32"
+RECORDING_SUBTYPE = "PCM_24"
+
+# Whether the sounddevice internals used by _read_into are available.
+_HAS_RAW_READ = all(hasattr(sd, name) for name in ("_lib", "_ffi", "_check"))
+
+# MIDI events are scheduled by sleeping until this long before they are due, then
+# busy-waiting on the stream clock, since time.sleep() overshoots by several ms.
+SPIN_WAIT_SEC = 0.002
+
+
+def _scan_midi_files(root: str | os.PathLike):
+    """Recursively yield the directory entries of all ".mid" files beneath root.
+
+    Uses os.scandir directly, which avoids the per-entry glob matching and Path
+    construction of Path.rglob; the directory check comes from the entry's file type
+    without an extra stat() on most platforms. Like Path.rglob, directories that
+    cannot be read are skipped.
+    """
+    try:
+        entries = os.scandir(root)
+    except PermissionError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan_midi_files(entry.path)
+            elif entry.name.lower().endswith(".mid"):
+                yield entry
+
+
+def _bytes_sender(out_port):
+    """Return a function that sends raw MIDI bytes to out_port.
+
+    With mido's rtmidi backend the bytes are handed straight to rtmidi, skipping the
+    construction and re-serialization of a mido.Message for every event.
+    """
+    rt = getattr(out_port, "_rt", None)
+    if rt is not None:
+        return rt.send_message
+    return lambda data: out_port.send(Message.from_bytes(data))
+
+
+def _read_into(input_stream: sd.InputStream, out: np.ndarray) -> bool:
+    """Read len(out) frames from input_stream directly into out.
+
+    Equivalent to input_stream.read(len(out)), except that PortAudio copies the samples
+    straight into the (C-contiguous) destination array, so nothing is allocated per
+    block. The GIL is released while PortAudio waits for audio.
+
+    This relies on sounddevice internals; if they are not available, it falls back to
+    input_stream.read() and a copy.
+
+    Returns True if input was discarded by PortAudio since the previous read.
+    """
+    # PortAudio writes len(out) frames in the stream's format, so out must match it
+    # exactly or the write would overrun the array.
+    if out.ndim != 2 or out.shape[1] != input_stream.channels:
+        raise ValueError(
+            f"Buffer of shape {out.shape} does not match a {input_stream.channels}-channel stream"
+        )
+    if out.dtype != np.dtype(input_stream.dtype):
+        raise ValueError(
+            f"Buffer dtype {out.dtype} does not match stream dtype {input_stream.dtype}"
+        )
+    if not out.flags.c_contiguous:
+        raise ValueError("Buffer must be C-contiguous")
+
+    ptr = getattr(input_stream, "_ptr", None)
+    if not _HAS_RAW_READ or ptr is None:
+        data, overflowed = input_stream.read(len(out))
+        out[:] = data
+        return overflowed
+
+    err = sd._lib.Pa_ReadStream(ptr, sd._ffi.from_buffer(out), len(out))
+    if err == sd._lib.paInputOverflowed:
+        return True
+    sd._check(err)
+    return False
+
+
+def _open_input_stream(
+    input_audio_device: int,
+    num_channels: int,
+    channel_map: list[int],
+    sample_rate: int,
+    input_blocksize: int,
+    input_latency: str | float,
+) -> sd.InputStream:
+    """Open (but do not start) the blocking input stream used for recording."""
+    core_audio_settings = None
+    if channel_map:
+        core_audio_settings = sd.CoreAudioSettings(channel_map=channel_map)
+
+    input_stream = sd.InputStream(
+        device=input_audio_device,
+        samplerate=sample_rate,
+        channels=num_channels,
+        dtype=RECORDING_DTYPE,
+        blocksize=input_blocksize,
+        latency=input_latency,
+        extra_settings=core_audio_settings,
+    )
+    logging.info("Input stream latency: %f s", input_stream.latency)
+    return input_stream
+
+
+@contextmanager
+def _started(input_stream: sd.InputStream):
+    """Run input_stream for the duration of the context, leaving it open afterwards.
+
+    Starting the stream discards anything PortAudio buffered while it was stopped, so
+    each session only records audio from after it began.
+    """
+    input_stream.start()
+    try:
+        yield input_stream
+    finally:
+        input_stream.stop()
+
 
 def capture_performance(
     input_midi_filepath: str,
@@ -26,12 +157,19 @@ def capture_performance(
     num_channels: int = 2,
     channel_map: list[int] = None,
     sample_rate: int = 44100,
+    input_blocksize: int = 256,
+    input_latency: str | float = "high",
+    input_stream: sd.InputStream = None,
+    out_port: mido.ports.BaseOutput = None,
 ):
     """Execute a MIDI playback with audio recording session.
 
     Plays a MIDI file through an output port and simultaneously captures audio data
     from a specified input audio source, writing the resulting wave to disk.
 
+    The MIDI output port and input audio stream are opened for this session, unless
+    already open ones are passed in (so that they can be reused across sessions).
+
     Args:
         input_midi_filepath:
             Path to MIDI file to play back.
@@ -53,20 +191,31 @@ def capture_performance(
         sample_rate:
             The sample rate to use for the audio recording. Note: the same value will
             be used for opening the input audio stream and for writing the file to disk.
+            Samples are captured as 32-bit integers and written as 24-bit PCM.
+        input_blocksize:
+            Number of frames per buffer of the input audio stream. Audio is read from
+            the stream in blocks of this size.
+        input_latency:
+            Suggested latency of the input audio stream, in seconds or one of "low" or
+            "high". Audio is pulled from the stream by a Python thread with blocking
+            reads, and PortAudio sizes the buffer it fills for those reads from this
+            latency. A larger latency gives that thread more headroom before input
+            overflows (dropouts) while the main thread schedules MIDI. It does not
+            delay MIDI playback relative to the recording, since events are timed
+            against the stream clock.
+        input_stream:
+            An open (stopped) input stream to record from, matching the settings above.
+            It is started for the session and stopped again afterwards.
+        out_port:
+            An open MIDI output port to play back through, instead of opening
+            output_port_name.
     """
-    audio_buffer = []
-
     if channel_map and num_channels != len(channel_map):
         print(
             f"Error: num_channels ({num_channels}) does not equal len(channel_map) ({len(channel_map)})!"
         )
         return
 
-    def recording_callback(indata, frames, time, status):
-        if status:
-            print(status, file=sys.stderr)
-        audio_buffer.append(indata.copy())
-
     try:
         mid = MidiFile(input_midi_filepath)
     except Exception as e:
@@ -74,62 +223,129 @@ def capture_performance(
         print("Skipping")
         return
 
-    core_audio_settings = None
-    if channel_map:
-        core_audio_settings = sd.CoreAudioSettings(channel_map=channel_map)
-
-    with open_output(output_port_name) as out_port:
-        with sf.SoundFile(
-            output_audio_filepath,
-            mode="w",
-            samplerate=sample_rate,
-            channels=num_channels,
-            subtype="PCM_24",
-        ) as file:
-            try:
-                with sd.InputStream(
-                    device=input_audio_device,
-                    samplerate=sample_rate,
-                    channels=num_channels,
-                    callback=recording_callback,
-                    extra_settings=core_audio_settings,
-                ) as input_stream:
+    # Decode the whole file up front (including tempo changes, which mido resolves
+    # into seconds) into a schedule of absolute event times and the raw bytes to send
+    # at each, so the playback loop does no parsing or serialization. Meta messages
+    # are dropped here; their delta times are already folded into the absolute times
+    # of the messages that follow them.
+    events = list(mid)
+    abs_times = np.cumsum([msg.time for msg in events], dtype=np.float64).tolist()
+    duration_sec = abs_times[-1] if abs_times else 0.0
+    event_times = [t for t, msg in zip(abs_times, events) if not msg.is_meta]
+    event_bytes = [msg.bytes() for msg in events if not msg.is_meta]
+
+    # Preallocate the whole recording; the reader only copies each block into place
+    # and advances the write cursor.
+    max_frames = int((duration_sec + RECORDING_PAD_SEC) * sample_rate)
+    audio_buffer = np.empty((max_frames, num_channels), dtype=RECORDING_DTYPE)
+    # Touch every page now so that page faults do not land on the reader thread.
+    audio_buffer.fill(0)
+    capture = SimpleNamespace(frames=0, error=None)
+    recording = threading.Event()
+
+    def read_audio(input_stream):
+        # Blocking reads wait inside PortAudio, so the realtime audio thread never
+        # has to acquire the GIL. Any error is handed back to the main thread, which
+        # stops playback and re-raises it after joining this thread.
+        try:
+            while recording.is_set():
+                start = capture.frames
+                stop = min(start + input_blocksize, max_frames)
+                if start == stop:
+                    print("audio buffer full, recording stopped", file=sys.stderr)
+                    break
+                if _read_into(input_stream, audio_buffer[start:stop]):
+                    print("input overflow", file=sys.stderr)
+                capture.frames = stop
+        except BaseException as e:
+            capture.error = e
+
+    with ExitStack() as stack:
+        if out_port is None:
+            out_port = stack.enter_context(open_output(output_port_name))
+        if input_stream is None:
+            input_stream = stack.enter_context(
+                closing(
+                    _open_input_stream(
+                        input_audio_device,
+                        num_channels,
+                        channel_map,
+                        sample_rate,
+                        input_blocksize,
+                        input_latency,
+                    )
+                )
+            )
+
+        try:
+            with gc_paused(), _started(input_stream):
+                recording.set()
+                reader = threading.Thread(
+                    target=read_audio, args=(input_stream,), daemon=True
+                )
+                reader.start()
+
+                # The reader must have left PortAudio before the stream is stopped (or
+                # closed), however playback ends, since PortAudio is not thread-safe.
+                try:
                     # Version of mido.MidiFile.play() to use sounddevice.Stream.time
                     # instead of time.time().
                     #
-                    # This allows us to synchronize the MIDI events to the audio stream.
+                    # This allows us to synchronize the MIDI events to the audio
+                    # stream.
 
+                    send_bytes = _bytes_sender(out_port)
                     start_time = input_stream.time
-                    input_time = 0.0
-
-                    for msg in mid:
-                        input_time += msg.time
-                        playback_time = input_stream.time - start_time
-                        duration_to_next_event = input_time - playback_time
-
-                        if duration_to_next_event > 0.0:
-                            time.sleep(duration_to_next_event)
-
-                        if isinstance(msg, MetaMessage):
-                            continue
-
-                        out_port.send(msg)
 
-                    # Slightly lengthen capture session to avoid any unexpected cutoff
-                    # TODO: set this based on delay_ms?
-                    time.sleep(3)
-
-                    # Write wavefile to disk
-                    for data in audio_buffer:
-                        file.write(data)
-            except KeyboardInterrupt:
-                print()
-                print("Tearing down session...")
-                file.close()
-                Path(file.name).unlink()
+                    for event_time, data in zip(event_times, event_bytes):
+                        if capture.error is not None:
+                            break
+
+                        event_time += start_time
+                        duration_to_next_event = event_time - input_stream.time
+
+                        if duration_to_next_event > SPIN_WAIT_SEC:
+                            time.sleep(duration_to_next_event - SPIN_WAIT_SEC)
+                        while input_stream.time < event_time:
+                            pass
+
+                        send_bytes(data)
+                    else:
+                        # Wait out any trailing meta messages (e.g. a delayed
+                        # end_of_track)
+                        duration_to_end = start_time + duration_sec - input_stream.time
+                        if duration_to_end > 0.0:
+                            time.sleep(duration_to_end)
+
+                        # Slightly lengthen capture session to avoid any unexpected
+                        # cutoff
+                        # TODO: set this based on delay_ms?
+                        time.sleep(3)
+                finally:
+                    recording.clear()
+                    reader.join()
+
+            # A failed take must not be written, or a resumed run would skip it.
+            # Playback may have stopped between a note_on and its note_off (or with the
+            # pedal down), so silence the instrument first.
+            if capture.error is not None:
                 out_port.reset()
-                out_port.close()
-                sys.exit(130)
+                raise capture.error
+
+            # Write wavefile to disk in a single call, once the recording is complete
+            sf.write(
+                output_audio_filepath,
+                audio_buffer[: capture.frames],
+                sample_rate,
+                subtype=RECORDING_SUBTYPE,
+            )
+        except KeyboardInterrupt:
+            print()
+            print("Tearing down session...")
+            Path(output_audio_filepath).unlink(missing_ok=True)
+            out_port.reset()
+            out_port.close()
+            sys.exit(130)
 
 
 def run(
@@ -144,6 +360,8 @@ def run(
     realtime: bool = True,
     output_suffix: str = "",
     cooldown_parameters: tuple[int] = (15, 3),
+    input_blocksize: int = 256,
+    input_latency: str | float = "high",
 ):
     """Play MIDI files and record audio for each performance.
 
@@ -195,6 +413,12 @@ def run(
             (15, 3) mean we sleep 3 minutes whenever our playback duration has exceeded 15 minutes
             from the last sleep. We never interrupt a performance, which results in slightly more
             playing time than playtime_min.
+        input_blocksize:
+            Number of frames per buffer of the input audio stream.
+        input_latency:
+            Suggested latency of the input audio stream, in seconds or one of "low" or
+            "high". Larger values give the audio reader thread more headroom before
+            input overflows; see capture_performance.
     """
     print_banner()
     print()
@@ -221,8 +445,13 @@ def run(
 
     midi_root = Path(input_midi_root).absolute()
     audio_root = Path(output_audio_root).absolute()
-    midi_filepaths = list(midi_root.rglob("*.[Mm][Ii][Dd]"))
-    midi_filepaths = sorted(midi_filepaths, key=lambda p: p.stat().st_size)
+
+    # Perform the smallest files first. Each file is stat'd exactly once, and ties are
+    # broken by path so the order is reproducible between runs.
+    file_sizes = sorted(
+        (entry.stat().st_size, Path(entry.path)) for entry in _scan_midi_files(midi_root)
+    )
+    midi_filepaths = [p for _, p in file_sizes]
 
     print(f"Preparing to record {len(midi_filepaths)} MIDI files beneath {midi_root}")
 
@@ -236,33 +465,54 @@ def run(
     # Set current time for cooldown timer
     cooldown_timer = time.time()
 
-    for input_midi_filepath in (progress_bar := tqdm(midi_filepaths)):
-        if time.time() - cooldown_timer > cooldown_threshold_sec:
-            time.sleep(cooldown_duration_sec)
-            cooldown_timer = time.time()
-
-        relative_midi_path = input_midi_filepath.relative_to(midi_root)
-        relative_audio_path = (
-            Path(relative_midi_path)
-            .with_name(f"{relative_midi_path.stem}{output_suffix}")
-            .with_suffix(f".wav")
-        )
-        output_audio_filepath = Path(audio_root, relative_audio_path)
-        if output_audio_filepath.exists():
-            print("Skipping MIDI file because output exists:", output_audio_filepath)
-            continue
-        Path(output_audio_filepath).parent.mkdir(parents=True, exist_ok=True)
-        progress_bar.set_description(f"Processing {relative_midi_path}")
-        capture_performance(
-            input_midi_filepath,
-            output_audio_filepath,
-            output_port_name,
+    # Open the MIDI port and audio device once for the whole run; each performance
+    # only starts and stops the stream.
+    with closing(
+        _open_input_stream(
             input_audio_device,
-            delay_ms,
             num_channels,
             channel_map,
             sample_rate,
+            input_blocksize,
+            input_latency,
+        )
+    ) as input_stream, open_output(output_port_name) as out_port:
+        # Refresh the progress bar at most once a second (and not at all when stderr
+        # is not a terminal) so it takes as little time as possible from recording.
+        progress_bar = tqdm(
+            midi_filepaths, mininterval=1.0, disable=not sys.stderr.isatty()
         )
+        for input_midi_filepath in progress_bar:
+            if time.time() - cooldown_timer > cooldown_threshold_sec:
+                time.sleep(cooldown_duration_sec)
+                cooldown_timer = time.time()
+
+            relative_midi_path = input_midi_filepath.relative_to(midi_root)
+            relative_audio_path = (
+                Path(relative_midi_path)
+                .with_name(f"{relative_midi_path.stem}{output_suffix}")
+                .with_suffix(f".wav")
+            )
+            output_audio_filepath = Path(audio_root, relative_audio_path)
+            if output_audio_filepath.exists():
+                print("Skipping MIDI file because output exists:", output_audio_filepath)
+                continue
+            Path(output_audio_filepath).parent.mkdir(parents=True, exist_ok=True)
+            progress_bar.set_description(f"Processing {relative_midi_path}")
+            capture_performance(
+                input_midi_filepath,
+                output_audio_filepath,
+                output_port_name,
+                input_audio_device,
+                delay_ms,
+                num_channels,
+                channel_map,
+                sample_rate,
+                input_blocksize=input_blocksize,
+                input_latency=input_latency,
+                input_stream=input_stream,
+                out_port=out_port,
+            )
 
 
 if __name__ == "__main__":
@@ -2,7 +2,6 @@ import ctypes, ctypes.util
 import sys
 import time
 import logging
-import numpy as np
 
 cocoa = ctypes.cdll.LoadLibrary(ctypes.util.find_library("Cocoa"))
 
@@ -34,20 +33,11 @@ def enable_realtime():
     if err != KERN_SUCCESS:
         raise RuntimeError("Failed to set thread policy with thread_policy_set")
     else:
-        params = (
-            np.array(
-                [
-                    policy.period,
-                    policy.computation,
-                    policy.constrain,
-                ]
-            )
-            / 1000.0
-        )
         logging.info(
-            "Successfully set thread to realtime (parameters: %d %d %d)".format(
-                x[1] for x in enumerate(params)
-            )
+            "Successfully set thread to realtime (parameters: %f %f %f)",
+            policy.period / 1000.0,
+            policy.computation / 1000.0,
+            policy.constrain / 1000.0,
         )
 
 
@@ -2,11 +2,98 @@ from __future__ import annotations
 
 import ffmpeg
 import fire
+import numpy as np
 import soundfile as sf
+import sys
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from tqdm import tqdm
 
+# Number of files converted by a single ffmpeg invocation.
+FFMPEG_BATCH_SIZE = 32
+
+# Number of frames mixed at a time, which bounds memory use regardless of file length.
+MIX_BLOCKSIZE = 1 << 16
+
+
+def _weight_matrix(output_weights: list[list[float]]) -> np.ndarray:
+    """Stack per-output weight lists into an (input channels, output channels) matrix.
+
+    Input channels without a weight in a given list contribute nothing to that output.
+    """
+    weights = np.zeros(
+        (max(len(w) for w in output_weights), len(output_weights)), dtype=np.float32
+    )
+    for idx, w in enumerate(output_weights):
+        weights[: len(w), idx] = w
+    return weights
+
+
+def _pan_expr(weights: list[float]) -> str:
+    """Format one output channel's weights as an ffmpeg pan expression.
+
+    Zero-weighted input channels are left out of the expression.
+    """
+    terms = [f"{w}*c{idx}" for idx, w in enumerate(weights) if w != 0]
+    return "+".join(terms) or "0*c0"
+
+
+def _mix_file(
+    input_path: Path,
+    output_path: Path,
+    channels: slice,
+    weights: np.ndarray,
+    offset_sec: float,
+):
+    """Trim and mix down a WAV file, one block (and matrix product) at a time.
+
+    Only the given contiguous range of input channels is mixed, with one row of
+    weights per channel. Blocks are read, mixed and clipped in place in two
+    preallocated buffers, so the only pass over the samples besides the matrix product
+    is libsndfile's conversion to PCM on write.
+    """
+    info = sf.info(str(input_path))
+    if info.channels < channels.stop:
+        raise ValueError(
+            f"{input_path} has {info.channels} channels but {channels.stop} weights were given"
+        )
+
+    input_buffer = np.empty((MIX_BLOCKSIZE, info.channels), dtype=np.float32)
+    output_buffer = np.empty((MIX_BLOCKSIZE, weights.shape[1]), dtype=np.float32)
+
+    with sf.SoundFile(
+        str(output_path), "w", samplerate=info.samplerate, channels=weights.shape[1]
+    ) as output_file:
+        for block in sf.blocks(
+            str(input_path),
+            start=int(offset_sec * info.samplerate),
+            out=input_buffer,
+        ):
+            mixed = output_buffer[: len(block)]
+            np.matmul(block[:, channels], weights, out=mixed)
+            np.clip(mixed, -1.0, 1.0, out=mixed)
+            output_file.write(mixed)
+
+
+def _convert_batch(
+    batch: list[tuple[Path, Path]], af_expr: str, sample_rate: int, offset_sec: float
+):
+    """Trim, mix down and resample several WAV files with one ffmpeg invocation.
+
+    Each input is mapped to its own output with the same pan filter, which amortizes
+    ffmpeg's process startup over the batch.
+    """
+    outputs = [
+        ffmpeg
+        .input(str(p), ss=offset_sec)
+        .audio
+        .output(str(output_path), af=af_expr, ar=sample_rate)
+        for p, output_path in batch
+    ]
+    ffmpeg.merge_outputs(*outputs).run(quiet=True, overwrite_output=True)
+
+
 def process_wav_files(
     audio_root: str,
     output_root: str,
@@ -17,45 +104,116 @@ def process_wav_files(
     stereo_c0_weights: list[float] = None,
     stereo_c1_weights: list[float] = None,
     overwrite: bool = False,
+    num_workers: int = None,
 ):
+    """Trim and mix down all WAV files beneath audio_root.
+
+    Each file is trimmed by offset_ms and mixed down to mono (or stereo) as a weighted
+    sum of its channels, then written to the same relative path beneath output_root.
+    Files already at sample_rate are mixed with NumPy; others are resampled by ffmpeg.
+
+    Args:
+        audio_root:
+            Path to the root directory of captured WAV files.
+        output_root:
+            Path to the root directory for the processed WAV files.
+        sample_rate:
+            Sample rate of the processed files.
+        offset_ms:
+            Amount of audio to trim from the start of each file.
+        channel_weights:
+            Weight of each input channel in the mono mix. Leading and trailing
+            channels with a weight of zero (in every output) are left out of the
+            matrix product rather than multiplied by zero. They are still decoded.
+        stereo:
+            Mix down to stereo using stereo_c0_weights and stereo_c1_weights instead of
+            to mono using channel_weights.
+        stereo_c0_weights:
+            Weight of each input channel in the left output channel.
+        stereo_c1_weights:
+            Weight of each input channel in the right output channel.
+        overwrite:
+            Overwrite existing output files instead of skipping them.
+        num_workers:
+            Number of worker processes. Default is the number of CPUs.
+    """
     audio_root = Path(audio_root)
     output_root = Path(output_root)
     audio_paths = list(audio_root.rglob("*.wav"))
     offset_sec = offset_ms * 0.001
 
-    # ffmpeg settings:
+    # Mixing settings:
     if stereo:
         if (stereo_c0_weights is None) or (len(stereo_c0_weights) < 1):
             raise ValueError("Must specify weights for stereo_c0_weights")
         if (stereo_c1_weights is None) or (len(stereo_c1_weights) < 1):
-            raise ValueError("Must specify weights for stereo_c0_weights")
+            raise ValueError("Must specify weights for stereo_c1_weights")
 
-        c0_expr = "+".join([f"{w}*c{idx}" for idx, w in enumerate(stereo_c0_weights)])
-        c1_expr = "+".join([f"{w}*c{idx}" for idx, w in enumerate(stereo_c1_weights)])
+        c0_expr = _pan_expr(stereo_c0_weights)
+        c1_expr = _pan_expr(stereo_c1_weights)
         af_expr = f"pan=stereo|c0={c0_expr}|c1={c1_expr}"
+        weights = _weight_matrix([stereo_c0_weights, stereo_c1_weights])
     else:
-        if (channel_weights is None) or (len(channel_weights < 1)):
+        if (channel_weights is None) or (len(channel_weights) < 1):
             raise ValueError("Must specify weights for channel_weights")
 
-        af_expr = "+".join([f"{w}*c{idx}" for idx, w in enumerate(channel_weights)])
-        af_expr = f"pan=mono|c0={af_expr}"
+        af_expr = f"pan=mono|c0={_pan_expr(channel_weights)}"
+        weights = _weight_matrix([channel_weights])
 
-    for p in (pbar := tqdm(audio_paths)):
-        pbar.set_postfix_str(f"Processing: {p}")
+    # Leading and trailing input channels with zero weight in every output are left
+    # out of the mix. Slicing the contiguous range in between needs no copy.
+    nonzero = np.flatnonzero(weights.any(axis=1))
+    if len(nonzero):
+        channels = slice(int(nonzero[0]), int(nonzero[-1]) + 1)
+    else:
+        channels = slice(0, 0)
+    weights = weights[channels]
+
+    jobs = []
+    for p in audio_paths:
         output_path = Path(output_root, p.relative_to(audio_root))
 
         if (not overwrite) and output_path.exists():
-            pbar.set_postfix_str(f"Skipping: {p}")
             continue
 
         output_path.parent.mkdir(parents=True, exist_ok=True)
+        jobs.append((p, output_path))
+
+    if len(jobs) < len(audio_paths):
+        print(f"Skipping {len(audio_paths) - len(jobs)} files because output exists")
+
+    # Files already at the target sample rate are mixed directly in NumPy; ffmpeg is
+    # only needed when resampling.
+    mix_jobs = []
+    resample_jobs = []
+    for p, output_path in jobs:
+        if sf.info(str(p)).samplerate == sample_rate:
+            mix_jobs.append((p, output_path))
+        else:
+            resample_jobs.append((p, output_path))
+
+    # Every file is independent, so spread the work over a process pool.
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {}
+        for p, output_path in mix_jobs:
+            future = executor.submit(
+                _mix_file, p, output_path, channels, weights, offset_sec
+            )
+            futures[future] = 1
+        for i in range(0, len(resample_jobs), FFMPEG_BATCH_SIZE):
+            batch = resample_jobs[i : i + FFMPEG_BATCH_SIZE]
+            future = executor.submit(
+                _convert_batch, batch, af_expr, sample_rate, offset_sec
+            )
+            futures[future] = len(batch)
+
+        with tqdm(
+            total=len(jobs), mininterval=1.0, disable=not sys.stderr.isatty()
+        ) as pbar:
+            for future in as_completed(futures):
+                future.result()
+                pbar.update(futures[future])
 
-        (
-            ffmpeg
-            .input(str(p), ss=offset_sec)
-            .output(str(output_path), af=af_expr, ar=sample_rate)
-            .run(quiet=True, overwrite_output=True)
-        )
 
 if __name__ == "__main__":
     fire.Fire(process_wav_files)
@@ -1,6 +1,9 @@
+import gc
 import mido
 import sounddevice as sd
 
+from contextlib import contextmanager
+
 
 def print_banner():
     print(
@@ -22,6 +25,25 @@ def print_banner():
     )
 
 
+@contextmanager
+def gc_paused():
+    """Disable the garbage collector for the duration of the context.
+
+    Garbage is collected up front and the surviving objects are frozen, so nothing
+    allocated beforehand is scanned by a collection inside the context. Collection
+    resumes (and catches up) on exit.
+    """
+    gc.collect()
+    gc.freeze()
+    gc.disable()
+    try:
+        yield
+    finally:
+        gc.enable()
+        gc.unfreeze()
+        gc.collect()
+
+
 if __name__ == "__main__":
     print("mido.get_output_names()")
     print(mido.get_output_names())